@@ -1,21 +1,21 @@
-import base64
-import json
 import os
-from itertools import chain
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import modal
 import numpy as np
+import orjson
 import torch
-import yaml
 from huggingface_hub import login
 from more_itertools import chunked
+from PIL import Image
 from pydantic import BaseModel
-from scipy.optimize import linear_sum_assignment
 from tqdm import tqdm
 from vllm import LLM, SamplingParams
 from vllm.sampling_params import GuidedDecodingParams
 
+from metrics import compute_msa, summarize_msa
 from utils import (
     APP_NAME,
     DATA_VOL_PATH,
@@ -39,9 +39,12 @@ BASE_MODEL = "Qwen/Qwen2.5-VL-3B-Instruct"
 # DPO_MODEL = f"andrewhinh/{APP_NAME}-qwen2.5-vl-3b-instruct-lora-dpo-merged"
 # DPO_QUANT_MODEL = f"andrewhinh/{APP_NAME}-qwen2.5-vl-3b-instruct-lora-dpo-merged-awq"
 
-KV_CACHE_DTYPE = None  # "fp8_e5m2"
+KV_CACHE_DTYPE = "fp8_e5m2"  # used with --kv-fp8; otherwise the model dtype
+AWQ_MAX_NUM_SEQS = 32  # above this, --quant runs unquantized unless --force-quant
 ENFORCE_EAGER = False
-MAX_NUM_SEQS = 32 if modal.is_local() else 128
+MAX_NUM_SEQS = 32 if modal.is_local() else 256
+GPU_MEMORY_UTILIZATION = 0.9 if modal.is_local() else 0.97
+BATCH_SIZE = 4 * MAX_NUM_SEQS  # per llm.chat call; vLLM schedules within it
 MIN_PIXELS = 28 * 28
 MAX_PIXELS = 1280 * 28 * 28
 TEMPERATURE = 0.1
@@ -50,6 +53,7 @@ REPEATION_PENALTY = 1.1
 STOP_TOKEN_IDS = []
 MAX_MODEL_LEN = 8192 if modal.is_local() else 32768
 MAX_TOKENS = 4096
+LOAD_WORKERS = 8
 
 
 # -----------------------------------------------------------------------------
@@ -70,7 +74,29 @@ class Substructures(BaseModel):
     substructures: list[Substructure]
 
 
-JSON_STRUCTURE = Substructures.model_json_schema()
+CONVERSATION = [
+    {"role": "system", "content": DEFAULT_SYSTEM_PROMPT},
+    {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": DEFAULT_USER_PROMPT},
+            {"type": "image"},
+        ],
+    },
+]
+
+# built once so every batch shares one guided-decoding schema
+JSON_STRUCTURE = orjson.dumps(
+    Substructures.model_json_schema(), option=orjson.OPT_SORT_KEYS
+).decode()
+SAMPLING_PARAMS = SamplingParams(
+    temperature=TEMPERATURE,
+    top_p=TOP_P,
+    repetition_penalty=REPEATION_PENALTY,
+    stop_token_ids=STOP_TOKEN_IDS,
+    max_tokens=MAX_TOKENS,
+    guided_decoding=GuidedDecodingParams(json=JSON_STRUCTURE),
+)
 
 
 ## container startup fn
@@ -129,218 +155,84 @@ app = modal.App(name=f"{APP_NAME}-eval")
 # helpers
 
 
-def compute_msa_per_label(gts, preds):
-    n, m = len(gts), len(preds)
-    cost_matrix = np.zeros((n, m))
-    for i in range(n):
-        for j in range(m):
-            cost_matrix[i, j] = np.linalg.norm(np.array(gts[i]) - np.array(preds[j]))
-    gt_indices, pred_indices = linear_sum_assignment(cost_matrix)
-    matched_distances = cost_matrix[gt_indices, pred_indices]
-    num_matched = len(gt_indices)
-    return {
-        "average_euclidean_distance": np.mean(matched_distances)
-        if num_matched > 0
-        else 0.0,
-        "num_matched": num_matched,
-        "false_positives": m - num_matched,
-        "false_negatives": n - num_matched,
-    }
-
-
-def compute_msa(gt_list, pred_list):
-    all_metrics = []
-    for gt_labels, pred_labels in zip(gt_list, pred_list):
-        gt_ids, pred_ids = set(gt_labels.keys()), set(pred_labels.keys())
-        matched_ids = gt_ids & pred_ids
-        false_negative_labels = gt_ids - pred_ids
-        false_positive_labels = pred_ids - gt_ids
-        metrics = {
-            "num_matched_labels": len(matched_ids),
-            "false_positive_labels": len(false_positive_labels),
-            "false_negative_labels": len(false_negative_labels),
-            "point_metrics_per_label": [],
-        }
-        for label in matched_ids:
-            gt_points = gt_labels[label]
-            pred_points = pred_labels[label]
-            if len(gt_points) > 0 and len(pred_points) > 0:
-                metrics["point_metrics_per_label"].append(
-                    {"label": label, **compute_msa_per_label(gt_points, pred_points)}
-                )
-            elif len(gt_points) <= 0:
-                false_negative_labels.add(label)
-            elif len(pred_points) <= 0:
-                false_positive_labels.add(label)
-
-        # Add unmatched labels as metrics (FN for ground truth, FP for predictions)
-        for label in false_negative_labels:
-            metrics["point_metrics_per_label"].append(
-                {
-                    "label": label,
-                    "average_euclidean_distance": 0.0,
-                    "num_matched": 0,
-                    "false_positives": 0,
-                    "false_negatives": len(gt_labels[label]),
-                    "precision": 0.0,
-                    "recall": 0.0,
-                }
-            )
-        for label in false_positive_labels:
-            metrics["point_metrics_per_label"].append(
-                {
-                    "label": label,
-                    "average_euclidean_distance": 0.0,
-                    "num_matched": 0,
-                    "false_positives": len(pred_labels[label]),
-                    "false_negatives": 0,
-                    "precision": 0.0,
-                    "recall": 0.0,
-                }
-            )
-        all_metrics.append(metrics)
-    return all_metrics
-
-
-def summarize_msa(msa):
-    total_labels = {"matched": 0, "fp": 0, "fn": 0}
-    total_points = {"matched": 0, "fp": 0, "fn": 0, "euclidean_distance": 0.0}
-
-    for metric in msa:
-        total_labels["matched"] += metric["num_matched_labels"]
-        total_labels["fp"] += metric["false_positive_labels"]
-        total_labels["fn"] += metric["false_negative_labels"]
-        for point_metric in metric["point_metrics_per_label"]:
-            total_points["matched"] += point_metric["num_matched"]
-            total_points["fp"] += point_metric["false_positives"]
-            total_points["fn"] += point_metric["false_negatives"]
-            total_points["euclidean_distance"] += (
-                point_metric["average_euclidean_distance"] * point_metric["num_matched"]
-            )
+def _load_image(img_path: Path) -> Image.Image:
+    with Image.open(img_path) as img:
+        return img.convert("RGB")
 
-    # Compute metrics
-    label_precision = (
-        total_labels["matched"] / (total_labels["matched"] + total_labels["fp"])
-        if total_labels["fp"] + total_labels["matched"] > 0
-        else 0.0
-    )
-    label_recall = (
-        total_labels["matched"] / (total_labels["matched"] + total_labels["fn"])
-        if total_labels["fn"] + total_labels["matched"] > 0
-        else 0.0
-    )
-    label_f1 = (
-        2 * label_precision * label_recall / (label_precision + label_recall)
-        if label_precision + label_recall > 0
-        else 0.0
-    )
-    point_precision = (
-        total_points["matched"] / (total_points["matched"] + total_points["fp"])
-        if total_points["fp"] + total_points["matched"] > 0
-        else 0.0
-    )
-    point_recall = (
-        total_points["matched"] / (total_points["matched"] + total_points["fn"])
-        if total_points["fn"] + total_points["matched"] > 0
-        else 0.0
-    )
-    point_f1 = (
-        2 * point_precision * point_recall / (point_precision + point_recall)
-        if point_precision + point_recall > 0
-        else 0.0
-    )
-    avg_euclidean_distance = (
-        total_points["euclidean_distance"] / total_points["matched"]
-        if total_points["matched"] > 0
-        else float("inf")
-    )
 
-    return {
-        "label_metrics": {
-            "precision": round(label_precision, 2),
-            "recall": round(label_recall, 2),
-            "f1": round(label_f1, 2),
+def _prepare(img_paths: list[Path]) -> list[Image.Image]:
+    # hand vLLM decoded images directly instead of a base64 round-trip
+    with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as executor:
+        return list(executor.map(_load_image, img_paths))
+
+
+def _load_llm(model: str, quant: bool, kv_fp8: bool) -> LLM:
+    return LLM(
+        model=model,
+        enforce_eager=ENFORCE_EAGER,
+        max_num_seqs=MAX_NUM_SEQS,
+        gpu_memory_utilization=GPU_MEMORY_UTILIZATION,
+        tensor_parallel_size=GPU_COUNT,
+        trust_remote_code=True,
+        max_model_len=MAX_MODEL_LEN,
+        mm_processor_kwargs={
+            "min_pixels": MIN_PIXELS,
+            "max_pixels": MAX_PIXELS,
         },
-        "point_metrics": {
-            "precision": round(point_precision, 2),
-            "recall": round(point_recall, 2),
-            "f1": round(point_f1, 2),
-            "avg_euclidean_distance": round(avg_euclidean_distance, 2),
+        **{
+            k: v
+            for k, v in [
+                ("quantization", "awq_marlin" if quant else None),
+                ("kv_cache_dtype", KV_CACHE_DTYPE if kv_fp8 else None),
+            ]
+            if v is not None
         },
-    }
+    )
 
 
-@app.function(
+def _generate(llm: LLM, imgs: list[Image.Image]) -> list[dict]:
+    # the text is identical for every image, so render the chat template once
+    prompt = llm.get_tokenizer().apply_chat_template(
+        CONVERSATION, tokenize=False, add_generation_prompt=True
+    )
+    outputs = llm.generate(
+        [{"prompt": prompt, "multi_modal_data": {"image": img}} for img in imgs],
+        SAMPLING_PARAMS,
+        use_tqdm=True,
+    )
+    preds = []
+    for out in outputs:
+        pred = out.outputs[0].text
+        try:
+            preds.append(orjson.loads(pred)["substructures"])
+        except orjson.JSONDecodeError:  # e.g. truncated at MAX_TOKENS
+            print(pred, file=sys.stderr)
+            raise
+    return preds
+
+
+@app.cls(
     image=IMAGE,
     gpu=GPU_CONFIG,
     volumes=VOLUME_CONFIG,
     secrets=SECRETS,
     timeout=TIMEOUT,
 )
-def run_model(img_paths: list[Path], model: str, quant: bool) -> list[dict]:
-    conversations = []
-    for img_path in img_paths:
-        with open(img_path, "rb") as image_file:
-            base64_img = base64.b64encode(image_file.read()).decode("utf-8")
-        img_url = f"data:image/jpeg;base64,{base64_img}"
-        conversations.append(
-            [
-                {"role": "system", "content": DEFAULT_SYSTEM_PROMPT},
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": DEFAULT_USER_PROMPT},
-                        {"type": "image_url", "image_url": {"url": img_url}},
-                    ],
-                },
-            ]
-        )
+class VLM:
+    # one container pool per (model, quant), so a loaded llm is never reused
+    # for a different checkpoint
+    model: str = modal.parameter()
+    quant: int = modal.parameter(default=0)
+    kv_fp8: int = modal.parameter(default=0)
 
-    global quantization
-    global llm
-    global sampling_params
-    # load pretrained vlm if not already loaded
-    if "quantization" not in globals():
-        quantization = "awq_marlin" if quant else None
-    if "llm" not in globals():
-        llm = LLM(
-            model=model,
-            enforce_eager=ENFORCE_EAGER,
-            max_num_seqs=MAX_NUM_SEQS,
-            tensor_parallel_size=GPU_COUNT,
-            trust_remote_code=True,
-            max_model_len=MAX_MODEL_LEN,
-            mm_processor_kwargs={
-                "min_pixels": MIN_PIXELS,
-                "max_pixels": MAX_PIXELS,
-            },
-            **{
-                k: v
-                for k, v in [
-                    ("quantization", quantization),
-                    ("kv_cache_dtype", KV_CACHE_DTYPE),
-                ]
-                if v is not None
-            },
-        )
-    if "sampling_params" not in globals():
-        sampling_params = SamplingParams(
-            temperature=TEMPERATURE,
-            top_p=TOP_P,
-            repetition_penalty=REPEATION_PENALTY,
-            stop_token_ids=STOP_TOKEN_IDS,
-            max_tokens=MAX_TOKENS,
-            guided_decoding=GuidedDecodingParams(json=JSON_STRUCTURE),
-        )
-    outputs = llm.chat(conversations, sampling_params, use_tqdm=True)
-    preds = [out.outputs[0].text.strip() for out in outputs]
-    for pred in preds:
-        try:
-            json.loads(pred)
-        except Exception:
-            print(pred)
-    preds = [json.loads(pred)["substructures"] for pred in preds]
-    return preds
+    @modal.enter()
+    def load(self):
+        self.llm = _load_llm(self.model, bool(self.quant), bool(self.kv_fp8))
+
+    @modal.method()
+    def generate(self, img_paths: list[Path]) -> list[dict]:
+        # images are read from the shared volume inside the container
+        return _generate(self.llm, _prepare(img_paths))
 
 
 # -----------------------------------------------------------------------------
@@ -348,55 +240,90 @@ def run_model(img_paths: list[Path], model: str, quant: bool) -> list[dict]:
 # main
 
 
-def main(base: bool, sft: bool, dpo: bool, quant: bool):
+def main(
+    base: bool, sft: bool, dpo: bool, quant: bool, force_quant: bool, kv_fp8: bool
+):
     if not base and not sft and not dpo:
         raise ValueError("Must specify at least one of `base`, `sft`, or `dpo`)")
+    # awq dequant overhead outweighs its bandwidth savings once decode is
+    # compute-bound at large batch sizes, so use the unquantized model there
+    # unless `force_quant` is set
+    if quant and not force_quant and MAX_NUM_SEQS > AWQ_MAX_NUM_SEQS:
+        print(
+            f"MAX_NUM_SEQS={MAX_NUM_SEQS} > AWQ_MAX_NUM_SEQS={AWQ_MAX_NUM_SEQS}, "
+            "evaluating the unquantized model instead (pass `force_quant` to keep awq)"
+        )
+        quant = False
+
+    model = (
+        BASE_MODEL
+        if base and not quant
+        # else SFT_MODEL
+        # if sft and not quant
+        # else DPO_MODEL
+        # if dpo and not quant
+        # else BASE_QUANT_MODEL
+        # if base and quant
+        # else SFT_QUANT_MODEL
+        # if sft and quant
+        # else DPO_QUANT_MODEL
+        # if dpo and quant
+        else None
+    )
+    if modal.is_local():
+        llm = _load_llm(model, quant, kv_fp8)
+    else:
+        vlm = VLM(model=model, quant=int(quant), kv_fp8=int(kv_fp8))
 
     split_msa = {}
     for split in SPLITS:
-        with open(DATA_VOL_PATH / f"sft_{split}.json", "r") as f:
-            read_ds = yaml.safe_load(f)
-        img_paths = [sample["images"][0] for sample in read_ds]
-        labels = [json.loads(sample["conversations"][1]["value"]) for sample in read_ds]
+        with open(DATA_VOL_PATH / f"sft_{split}.json", "rb") as f:
+            read_ds = orjson.loads(f.read())
+        # single pass over the samples; points as (k, 2) float64 arrays
+        img_paths, labels = [], []
+        for sample in read_ds:
+            img_paths.append(sample["images"][0])
+            labels.append(
+                {
+                    name: np.asarray(points, dtype=np.float64).reshape(-1, 2)
+                    for name, points in orjson.loads(
+                        sample["conversations"][1]["value"]
+                    ).items()
+                }
+            )
+        del read_ds
 
         ## run
-        img_batches = list(chunked(img_paths, MAX_NUM_SEQS))
-        model = (
-            BASE_MODEL
-            if base and not quant
-            # else SFT_MODEL
-            # if sft and not quant
-            # else DPO_MODEL
-            # if dpo and not quant
-            # else BASE_QUANT_MODEL
-            # if base and quant
-            # else SFT_QUANT_MODEL
-            # if sft and quant
-            # else DPO_QUANT_MODEL
-            # if dpo and quant
-            else None
-        )
+        img_batches = list(chunked(img_paths, BATCH_SIZE))
         if modal.is_local():
-            preds = list(
-                tqdm(
-                    chain.from_iterable(
-                        run_model.local(batch, model, quant) for batch in img_batches
-                    ),
-                    desc=split,
-                    total=len(img_batches),
+            # prepare batch i + 1 while batch i is on the gpu
+            preds = []
+            with ThreadPoolExecutor(max_workers=1) as prefetcher:
+                # an empty split has nothing to prefetch; the loop below is a no-op
+                next_imgs = (
+                    prefetcher.submit(_prepare, img_batches[0]) if img_batches else None
                 )
-            )
+                for i in tqdm(range(len(img_batches)), desc=split):
+                    imgs = next_imgs.result()
+                    if i + 1 < len(img_batches):
+                        next_imgs = prefetcher.submit(_prepare, img_batches[i + 1])
+                    preds.extend(_generate(llm, imgs))
         else:
-            lst_preds = run_model.starmap(
-                [(batch, model, quant) for batch in img_batches]
-            )
+            lst_preds = vlm.generate.map(img_batches)
             preds = [item for lst in lst_preds for item in lst]
 
+        # match the labels' (k, 2) float64 layout
         preds = [
             {
-                substructure["name"]: [
-                    [point["x"], point["y"]] for point in substructure["points"]
-                ]
+                substructure["name"]: np.fromiter(
+                    (
+                        v
+                        for point in substructure["points"]
+                        for v in (point["x"], point["y"])
+                    ),
+                    dtype=np.float64,
+                    count=2 * len(substructure["points"]),
+                ).reshape(-1, 2)
                 for substructure in pred
             }
             for pred in preds
@@ -409,6 +336,8 @@ def main(base: bool, sft: bool, dpo: bool, quant: bool):
 
         print(f"\n{'='*50}")
         print(f"Metrics for Split: '{split}'")
+        print(f"Model: {model} ({'awq_marlin' if quant else 'unquantized'})")
+        print(f"KV Cache: {KV_CACHE_DTYPE if kv_fp8 else 'model dtype'}")
         print(f"{'='*50}")
         print(f"{'Metric':<25}{'Value':>10}")
         print(f"{'-'*50}")
@@ -442,15 +371,22 @@ def main(base: bool, sft: bool, dpo: bool, quant: bool):
     secrets=SECRETS,
     timeout=TIMEOUT,
 )
-def run(base: bool, sft: bool, dpo: bool, quant: bool):
-    main(base, sft, dpo, quant)
+def run(
+    base: bool, sft: bool, dpo: bool, quant: bool, force_quant: bool, kv_fp8: bool
+):
+    main(base, sft, dpo, quant, force_quant, kv_fp8)
 
 
 @app.local_entrypoint()
 def local(
-    base: bool = False, sft: bool = False, dpo: bool = False, quant: bool = False
+    base: bool = False,
+    sft: bool = False,
+    dpo: bool = False,
+    quant: bool = False,
+    force_quant: bool = False,
+    kv_fp8: bool = False,
 ):
-    run.remote(base, sft, dpo, quant)
+    run.remote(base, sft, dpo, quant, force_quant, kv_fp8)
 
 
 if __name__ == "__main__":
@@ -461,5 +397,9 @@ if __name__ == "__main__":
     parser.add_argument("--sft", action="store_true")
     parser.add_argument("--dpo", action="store_true")
     parser.add_argument("--quant", action="store_true")
+    parser.add_argument("--force-quant", action="store_true")
+    parser.add_argument("--kv-fp8", action="store_true")
     args = parser.parse_args()
-    main(args.base, args.sft, args.dpo, args.quant)
+    main(
+        args.base, args.sft, args.dpo, args.quant, args.force_quant, args.kv_fp8
+    )
@@ -0,0 +1,183 @@
+import math
+
+import numpy as np
+from numba import njit
+from scipy.optimize import linear_sum_assignment
+
+# -----------------------------------------------------------------------------
+
+# helpers
+
+
+@njit(cache=True, fastmath=True, boundscheck=False)
+def _sq_dist_matrix(gts, preds, out):
+    for i in range(gts.shape[0]):
+        for j in range(preds.shape[0]):
+            dx = gts[i, 0] - preds[j, 0]
+            dy = gts[i, 1] - preds[j, 1]
+            out[i, j] = dx * dx + dy * dy
+
+
+# compile on import so the first label doesn't pay for it
+_sq_dist_matrix(np.zeros((2, 2)), np.zeros((2, 2)), np.empty((2, 2)))
+
+
+def _label_metrics(average_euclidean_distance, num_matched, n, m):
+    return {
+        "average_euclidean_distance": average_euclidean_distance,
+        "num_matched": num_matched,
+        "false_positives": m - num_matched,
+        "false_negatives": n - num_matched,
+    }
+
+
+def compute_msa_per_label(gts, preds):
+    # no-op for the (k, 2) float64 arrays main builds; converts nested lists
+    gts = np.ascontiguousarray(gts, dtype=np.float64).reshape(-1, 2)
+    preds = np.ascontiguousarray(preds, dtype=np.float64).reshape(-1, 2)
+    n, m = len(gts), len(preds)
+    # trivial assignments skip the cost matrix and scipy's solver
+    if n == 0 or m == 0:
+        return _label_metrics(0.0, 0, n, m)
+    if n == 1 and m == 1:
+        (gx, gy), (px, py) = gts[0], preds[0]
+        return _label_metrics(math.hypot(gx - px, gy - py), 1, n, m)
+    if n == 1 or m == 1:
+        diff = preds - gts  # broadcasts the single point against the other side
+        dist = math.sqrt(np.einsum("ij,ij->i", diff, diff).min())
+        return _label_metrics(dist, 1, n, m)
+
+    cost_matrix = np.empty((n, m))
+    _sq_dist_matrix(gts, preds, cost_matrix)
+    # assignment must minimize summed (not squared) distance, so take sqrt in place
+    np.sqrt(cost_matrix, out=cost_matrix)
+    gt_indices, pred_indices = linear_sum_assignment(cost_matrix)
+    matched_distances = cost_matrix[gt_indices, pred_indices]
+    return _label_metrics(np.mean(matched_distances), len(gt_indices), n, m)
+
+
+_UNMATCHED_TMPL = {
+    "average_euclidean_distance": 0.0,
+    "num_matched": 0,
+    "false_positives": 0,
+    "false_negatives": 0,
+    "precision": 0.0,
+    "recall": 0.0,
+}
+
+
+def _metrics_for_sample(gt_labels, pred_labels):
+    gt_ids, pred_ids = set(gt_labels.keys()), set(pred_labels.keys())
+    matched_ids = gt_ids & pred_ids
+    false_negative_labels = gt_ids - pred_ids
+    false_positive_labels = pred_ids - gt_ids
+    metrics = {
+        "num_matched_labels": len(matched_ids),
+        "false_positive_labels": len(false_positive_labels),
+        "false_negative_labels": len(false_negative_labels),
+        "point_metrics_per_label": [],
+    }
+    for label in matched_ids:
+        gt_points = gt_labels[label]
+        pred_points = pred_labels[label]
+        if len(gt_points) > 0 and len(pred_points) > 0:
+            metrics["point_metrics_per_label"].append(
+                {"label": label, **compute_msa_per_label(gt_points, pred_points)}
+            )
+        elif len(gt_points) <= 0:
+            false_negative_labels.add(label)
+        elif len(pred_points) <= 0:
+            false_positive_labels.add(label)
+
+    # Add unmatched labels as metrics (FN for ground truth, FP for predictions)
+    metrics["point_metrics_per_label"].extend(
+        {**_UNMATCHED_TMPL, "label": label, "false_negatives": len(gt_labels[label])}
+        for label in false_negative_labels
+    )
+    metrics["point_metrics_per_label"].extend(
+        {**_UNMATCHED_TMPL, "label": label, "false_positives": len(pred_labels[label])}
+        for label in false_positive_labels
+    )
+    return metrics
+
+
+def compute_msa(gt_list, pred_list):
+    return [_metrics_for_sample(g, p) for g, p in zip(gt_list, pred_list)]
+
+
+def summarize_msa(msa):
+    total_labels = {
+        "matched": sum(metric["num_matched_labels"] for metric in msa),
+        "fp": sum(metric["false_positive_labels"] for metric in msa),
+        "fn": sum(metric["false_negative_labels"] for metric in msa),
+    }
+
+    # flatten per-label point metrics into aligned arrays and reduce in numpy
+    point_metrics = [pm for metric in msa for pm in metric["point_metrics_per_label"]]
+    n = len(point_metrics)
+    matched, fp, fn = (
+        np.fromiter((pm[k] for pm in point_metrics), dtype=np.int64, count=n)
+        for k in ("num_matched", "false_positives", "false_negatives")
+    )
+    avg_dist = np.fromiter(
+        (pm["average_euclidean_distance"] for pm in point_metrics),
+        dtype=np.float64,
+        count=n,
+    )
+    total_points = {
+        "matched": int(matched.sum()),
+        "fp": int(fp.sum()),
+        "fn": int(fn.sum()),
+        "euclidean_distance": float(np.dot(matched, avg_dist)),
+    }
+
+    # Compute metrics
+    label_precision = (
+        total_labels["matched"] / (total_labels["matched"] + total_labels["fp"])
+        if total_labels["fp"] + total_labels["matched"] > 0
+        else 0.0
+    )
+    label_recall = (
+        total_labels["matched"] / (total_labels["matched"] + total_labels["fn"])
+        if total_labels["fn"] + total_labels["matched"] > 0
+        else 0.0
+    )
+    label_f1 = (
+        2 * label_precision * label_recall / (label_precision + label_recall)
+        if label_precision + label_recall > 0
+        else 0.0
+    )
+    point_precision = (
+        total_points["matched"] / (total_points["matched"] + total_points["fp"])
+        if total_points["fp"] + total_points["matched"] > 0
+        else 0.0
+    )
+    point_recall = (
+        total_points["matched"] / (total_points["matched"] + total_points["fn"])
+        if total_points["fn"] + total_points["matched"] > 0
+        else 0.0
+    )
+    point_f1 = (
+        2 * point_precision * point_recall / (point_precision + point_recall)
+        if point_precision + point_recall > 0
+        else 0.0
+    )
+    avg_euclidean_distance = (
+        total_points["euclidean_distance"] / total_points["matched"]
+        if total_points["matched"] > 0
+        else float("inf")
+    )
+
+    return {
+        "label_metrics": {
+            "precision": round(label_precision, 2),
+            "recall": round(label_recall, 2),
+            "f1": round(label_f1, 2),
+        },
+        "point_metrics": {
+            "precision": round(point_precision, 2),
+            "recall": round(point_recall, 2),
+            "f1": round(point_f1, 2),
+            "avg_euclidean_distance": round(avg_euclidean_distance, 2),
+        },
+    }
@@ -73,7 +73,9 @@ GPU_IMAGE = (
         "matplotlib>=3.10.0",
         "modal>=0.73.24",
         "more-itertools>=10.6.0",
+        "numba>=0.61.0",
         "opencv-python>=4.11.0.86",
+        "orjson>=3.10.15",
         "python-dotenv>=1.0.1",
         "pyyaml>=6.0.2",
         "requests>=2.32.3",